@@ -1,23 +1,35 @@
 import os
+import asyncio
 import hashlib
 import hmac
-import json
 import time
 import logging
+import ssl
 import urllib.parse
-from typing import Dict, List, Optional
+from collections import Counter, OrderedDict, defaultdict
+from typing import Dict, Optional, Set
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from supabase import create_client, Client
+from fastapi.responses import ORJSONResponse, Response
+from supabase import acreate_client, AsyncClient
+from postgrest.exceptions import APIError
 from contextlib import asynccontextmanager
 from aiogram import Bot
 from aiogram.types import Update, WebAppInfo, InlineKeyboardMarkup, InlineKeyboardButton
-import weakref
-import uuid
-import aiohttp
+import secrets
+import orjson
+import msgpack
+import redis.asyncio as aioredis
 from dotenv import load_dotenv
 
+# uvloop вместо стандартного цикла asyncio, если он установлен (ставится с uvicorn[standard])
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 # Загрузка переменных окружения
 load_dotenv()
 
@@ -30,140 +42,437 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Необязательно: без Redis рассылка идёт только по сокетам текущего процесса
+REDIS_URL = os.getenv("REDIS_URL")
+# STRICT_BOARD=1 включает проверку формы доски при каждом чтении из БД
+STRICT_BOARD = os.getenv("STRICT_BOARD") == "1"
 
 if not all([BOT_TOKEN, SUPABASE_URL, SUPABASE_KEY, WEBHOOK_URL]):
     raise EnvironmentError("Отсутствуют обязательные переменные окружения")
 
-supabase: Optional[Client] = None
-active_connections: Dict[str, List[weakref.ref]] = {}
-session = None
+# Ключ проверки initData зависит только от токена бота — считаем один раз
+SECRET_KEY = hmac.new(b"WebAppData", BOT_TOKEN.encode(), "sha256").digest()
+# Заранее инициализированный HMAC: при проверке копируем его вместо повторной обработки ключа
+HMAC_TEMPLATE = hmac.new(SECRET_KEY, digestmod="sha256")
+
+supabase: Optional[AsyncClient] = None
+# Сокеты игр; удаляются явно в disconnect, поэтому ссылки обычные, а не слабые
+active_connections: Dict[str, Set[WebSocket]] = defaultdict(set)
+redis_client: Optional[aioredis.Redis] = None
+# Задачи, пересылающие сообщения канала Redis game:{game_id} локальным сокетам
+redis_relays: Dict[str, asyncio.Task] = {}
+# Пауза перед повторной подпиской после ошибки Redis: удваивается до REDIS_RETRY_MAX_DELAY
+REDIS_RETRY_DELAY = 1
+REDIS_RETRY_MAX_DELAY = 30
+# Исходящие кадры каждого сокета игры: ограниченная очередь и задача, которая её отправляет
+SEND_QUEUE_SIZE = 16
+socket_writers: Dict[WebSocket, tuple] = {}
+# Задачи закрытия медленных сокетов: держим ссылки, иначе задачу может собрать сборщик мусора
+closing_sockets: Set[asyncio.Task] = set()
+# Ограничения на число сокетов игр: всего на процесс и на одного пользователя
+MAX_CONNECTIONS = 1000
+MAX_CONNECTIONS_PER_USER = 5
+user_connections: Counter = Counter()
+# Последняя разосланная версия каждой игры: (payload, время) — повторы в пределах окна не рассылаются
+BROADCAST_DEDUP_WINDOW = 0.02
+last_broadcasts: Dict[str, tuple] = {}
+# Обновления игры, пришедшие в течение BROADCAST_COALESCE_DELAY, уходят клиентам одним кадром
+BROADCAST_COALESCE_DELAY = 0.01
+pending_updates: Dict[str, asyncio.Task] = {}
+# Последнее состояние игры для запланированной рассылки: его передают вызывающие, повторного чтения нет
+pending_games: Dict[str, dict] = {}
+# Клавиатура для /start не зависит от запроса
+START_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Создать новую игру", web_app=WebAppInfo(url=f"{WEBHOOK_URL}/mini/index.html"))]
+])
+# Тип сообщения WebSocket — первый байт кадра, дальше данные в MessagePack
+MSG_GAME = b"\x01"
+MSG_CHAT = b"\x02"
+# Кэш игр в памяти процесса: чтение из Supabase только при промахе
+# Вытесняются давно не использованные игры, чтобы кэш не рос без ограничений
+GAME_CACHE_SIZE = 10_000
+GAME_CACHE: "OrderedDict[str, dict]" = OrderedDict()
+# С Redis игру могут изменить другие воркеры — тогда доверяем кэшу не дольше GAME_CACHE_TTL секунд
+GAME_CACHE_TTL = 5
+# Запущенные чтения игр: одновременные промахи по одной игре ждут один запрос к Supabase
+game_fetches: Dict[str, asyncio.Task] = {}
+# Игры, изменённые или сброшенные из кэша, пока их читал fetch_game: ответ такого SELECT мог устареть
+stale_fetches: Set[str] = set()
+GAME_FETCH_ATTEMPTS = 3
+# Кэш проверенных initData: blake2b(initData) -> (время истечения, данные пользователя)
+INIT_DATA_TTL = 86400
+INIT_DATA_CACHE_SIZE = 10_000
+INIT_DATA_CACHE: Dict[bytes, tuple] = {}
 
 # Валидация initData
-def validate_init_data(init_data: str, bot_token: str) -> dict: # Исправлено: init_data: str, а не init_ str
+def validate_init_data(init_data: str) -> dict:
+    cache_key = hashlib.blake2b(init_data.encode(), digest_size=16).digest()
+    cached = INIT_DATA_CACHE.get(cache_key)
+    if cached is not None:
+        expires_at, user_data = cached
+        if time.time() < expires_at:
+            return user_data
+        del INIT_DATA_CACHE[cache_key]
     try:
-        pairs = [pair.split("=", 1) for pair in init_data.split("&")]
-        data_dict = {}
-        received_hash = None
-        for k, v in pairs:
-            if k == "hash":
-                received_hash = urllib.parse.unquote(v)
-            else:
-                data_dict[k] = urllib.parse.unquote(v)
+        # parse_qsl разбирает и декодирует все поля за один проход
+        data_dict = dict(urllib.parse.parse_qsl(init_data, keep_blank_values=True, strict_parsing=True))
+        received_hash = data_dict.pop("hash", None)
         if received_hash is None:
             raise ValueError("Хэш не найден")
         auth_date = int(data_dict.get("auth_date", 0))
-        if time.time() - auth_date > 86400:
+        if time.time() - auth_date > INIT_DATA_TTL:
             raise HTTPException(status_code=403, detail="Истекло время действия initData")
-        data_check_pairs = [(k, v) for k, v in data_dict.items() if k != "hash"]
-        data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(data_check_pairs))
-        secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
-        computed_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-        if computed_hash != received_hash:
+        data_check_string = "\n".join(f"{k}={data_dict[k]}" for k in sorted(data_dict))
+        mac = HMAC_TEMPLATE.copy()
+        mac.update(data_check_string.encode())
+        computed_hash = mac.digest()
+        if not hmac.compare_digest(computed_hash, bytes.fromhex(received_hash)):
             raise HTTPException(status_code=403, detail="Некорректный хэш")
-        user_data = json.loads(data_dict["user"])
+        user_data = orjson.loads(data_dict["user"])
         logger.info(f"Пользователь успешно валидирован: ID {user_data.get('id')}")
+        if len(INIT_DATA_CACHE) >= INIT_DATA_CACHE_SIZE:
+            # Вытесняем самую старую запись
+            del INIT_DATA_CACHE[next(iter(INIT_DATA_CACHE))]
+        INIT_DATA_CACHE[cache_key] = (auth_date + INIT_DATA_TTL, user_data)
         return user_data
     except Exception as e:
         logger.error(f"Ошибка валидации: {e}")
         raise HTTPException(status_code=403, detail="Некорректные данные initData")
 
-# Работа с базой данных
-def is_game_id_unique(game_id: str) -> bool:
-    try:
-        result = supabase.table("games").select("id").eq("id", game_id).execute()
-        return not result.data
-    except Exception as e:
-        logger.error(f"Ошибка проверки уникальности game_id: {e}")
-        return False
+def pack_message(msg_type: bytes, data: dict) -> bytes:
+    return msg_type + msgpack.packb(data, use_bin_type=True)
+
+# Победитель передаётся клиенту числом: 0 — игра идёт, 1 — X, 2 — O, 3 — ничья
+WINNER_CODES = {None: 0, "X": 1, "O": 2, "draw": 3}
+
+def project_game(game: dict) -> dict:
+    # Короткие ключи: клиент получает только поля, нужные для отрисовки
+    return {
+        "x": game["x"],
+        "o": game["o"],
+        "u": game.get("current_turn"),
+        "w": WINNER_CODES[game.get("winner")],
+        "s": int(bool(game.get("game_started"))),
+        "c": game["creator_id"],
+        "p": game.get("opponent_id"),
+        "cn": game.get("creator_name"),
+        "pn": game.get("opponent_name"),
+    }
+
+# Доска: две 9-битные маски (X и O), клетка (row, col) — бит row*3 + col
+WIN_LINES = (0o007, 0o070, 0o700, 0o111, 0o222, 0o444, 0o421, 0o124)
+FULL_BOARD = 0o777
+
+def board_to_masks(board: list) -> tuple:
+    x = o = 0
+    for i, cell in enumerate(cell for row in board for cell in row):
+        if cell == "X":
+            x |= 1 << i
+        elif cell == "O":
+            o |= 1 << i
+    return x, o
+
+def masks_to_board(x: int, o: int) -> list:
+    return [["X" if x >> i & 1 else "O" if o >> i & 1 else None for i in range(r * 3, r * 3 + 3)] for r in range(3)]
+
+def check_win(mask: int) -> bool:
+    for line in WIN_LINES:
+        if mask & line == line:
+            return True
+    return False
 
-def get_game_by_id(game_id: str):
+# Работа с базой данных
+GAME_ID_ATTEMPTS = 3
+
+async def insert_new_game(game: dict) -> str:
+    # Уникальность id обеспечивает первичный ключ в БД: при коллизии пробуем другой id
+    for attempt in range(GAME_ID_ATTEMPTS):
+        # 6 случайных байт — ровно 8 URL-безопасных символов
+        game["id"] = secrets.token_urlsafe(6)
+        try:
+            await supabase.table("games").insert(game).execute()
+            return game["id"]
+        except APIError as e:
+            if e.code != "23505" or attempt == GAME_ID_ATTEMPTS - 1:
+                raise
+            logger.warning(f"Коллизия game_id {game['id']}, генерируем новый")
+
+def parse_board(board):
+    # Колонка board — jsonb, и её всегда пишет сервер, поэтому по умолчанию доверяем ей как есть
+    if not STRICT_BOARD:
+        return board
+    parsed_board = orjson.loads(board) if isinstance(board, str) else board
+    if not (isinstance(parsed_board, list) and len(parsed_board) == 3 and all(isinstance(row, list) and len(row) == 3 for row in parsed_board)):
+        raise ValueError(f"не массив 3x3: {board}")
+    return parsed_board
+
+def to_cached_game(game: dict) -> dict:
+    # В кэше доска хранится масками вместо списка списков
+    cached = {k: v for k, v in game.items() if k != "board"}
+    cached["x"], cached["o"] = board_to_masks(game.get("board") or [])
+    cached["cached_at"] = time.monotonic()
+    return cached
+
+def mark_game_changed(game_id: str):
+    if game_id in game_fetches:
+        stale_fetches.add(game_id)
+
+def drop_cached_game(game_id: str):
+    GAME_CACHE.pop(game_id, None)
+    mark_game_changed(game_id)
+
+def cache_game(game: dict) -> dict:
+    cached = to_cached_game(game)
+    GAME_CACHE[game["id"]] = cached
+    mark_game_changed(game["id"])
+    if len(GAME_CACHE) > GAME_CACHE_SIZE:
+        GAME_CACHE.popitem(last=False)
+    return cached
+
+def get_cached_game(game_id: str) -> Optional[dict]:
+    cached = GAME_CACHE.get(game_id)
+    if cached is None:
+        return None
+    if redis_client is not None and time.monotonic() - cached["cached_at"] > GAME_CACHE_TTL:
+        GAME_CACHE.pop(game_id, None)
+        return None
+    GAME_CACHE.move_to_end(game_id)
+    return cached
+
+async def get_game_by_id(game_id: str) -> Optional[dict]:
+    cached = get_cached_game(game_id)
+    if cached is not None:
+        return cached
+    fetch = game_fetches.get(game_id)
+    if fetch is None:
+        fetch = asyncio.create_task(fetch_game(game_id))
+        game_fetches[game_id] = fetch
+        fetch.add_done_callback(lambda _: game_fetches.pop(game_id, None))
+    # shield: отмена одного ожидающего запроса не прерывает общее чтение
+    return await asyncio.shield(fetch)
+
+async def fetch_game(game_id: str) -> Optional[dict]:
     try:
-        result = supabase.table("games").select("*").eq("id", game_id).execute()
-        if result.data:
-            # Убедимся, что board - это список списков, а не строка
+        for attempt in range(1, GAME_FETCH_ATTEMPTS + 1):
+            stale_fetches.discard(game_id)
+            result = await supabase.table("games").select("*").eq("id", game_id).execute()
+            stale = game_id in stale_fetches
+            if stale:
+                # Пока шёл SELECT, игру записали или сбросили: берём более новую запись из кэша или читаем заново
+                cached = GAME_CACHE.get(game_id)
+                if cached is not None:
+                    return cached
+                if attempt < GAME_FETCH_ATTEMPTS:
+                    continue
+            if not result.data:
+                return None
             game_data = result.data[0]
-            board = game_data.get("board")
-            if isinstance(board, str):
-                try:
-                    parsed_board = json.loads(board)
-                    if isinstance(parsed_board, list) and len(parsed_board) == 3 and all(isinstance(row, list) and len(row) == 3 for row in parsed_board):
-                         game_data["board"] = parsed_board
-                         logger.debug(f"Доска для игры {game_id} была строкой, преобразована в список списков.")
-                    else:
-                         logger.error(f"Доска для игры {game_id} - строка, но не корректный JSON массив 3x3: {board}")
-                         # Возвращаем None или пустую игру, если доска испорчена
-                         return None
-                except json.JSONDecodeError:
-                    logger.error(f"Доска для игры {game_id} - строка, но не корректный JSON: {board}")
-                    # Возвращаем None или пустую игру, если доска испорчена
-                    return None
-            return result.data
-        return None
+            try:
+                game_data["board"] = parse_board(game_data.get("board"))
+            except ValueError as e:
+                # Возвращаем None, если доска испорчена
+                logger.error(f"Некорректная доска игры {game_id}: {e}")
+                return None
+            # Ответ, который мог устареть, отдаём вызывающему, но не кладём в кэш
+            return to_cached_game(game_data) if stale else cache_game(game_data)
     except Exception as e:
         logger.error(f"Ошибка получения игры: {e}")
         return None
+    finally:
+        stale_fetches.discard(game_id)
+
+async def get_checked_game(game_id: str, check) -> dict:
+    # check(game) поднимает HTTPException, если запрос к этой игре недопустим
+    game = await get_game_by_id(game_id)
+    if not game:
+        raise HTTPException(status_code=404, detail="Игра не найдена")
+    try:
+        check(game)
+    except HTTPException:
+        # Отказ мог дать устаревший кэш (игру изменил другой воркер): перечитываем из Supabase один раз
+        drop_cached_game(game_id)
+        game = await get_game_by_id(game_id)
+        if not game:
+            raise HTTPException(status_code=404, detail="Игра не найдена")
+        check(game)
+    return game
 
-def update_game(game_id: str, data: dict): # Исправлено: data: dict, а не  dict
+async def update_game(game_id: str, data: dict, expected: Optional[dict] = None) -> bool:
+    # expected — ожидаемые текущие значения полей: запись применяется, только если строка в БД им соответствует
     try:
-        # Убедимся, что board отправляется как список списков (Supabase сам его сериализует)
-        # Если board - строка, не пытаемся её парсить перед отправкой, а оставляем как есть или преобразуем обратно в список
-        board = data.get("board")
-        if isinstance(board, str):
-             # Если вдруг board пришёл строкой в update, попробуем его распарсить перед отправкой
-             try:
-                 parsed_board = json.loads(board)
-                 if isinstance(parsed_board, list) and len(parsed_board) == 3 and all(isinstance(row, list) and len(row) == 3 for row in parsed_board):
-                     data["board"] = parsed_board
-                     logger.debug(f"Доска в update_game была строкой, преобразована в список списков перед отправкой.")
-                 else:
-                     logger.error(f"Доска в update_game была строкой, но не корректный JSON массив 3x3: {board}")
-                     return # Не обновляем, если доска испорчена
-             except json.JSONDecodeError:
-                 logger.error(f"Доска в update_game была строкой, но не корректный JSON: {board}")
-                 return # Не обновляем, если доска испорчена
-        supabase.table("games").update(data).eq("id", game_id).execute()
+        db_data = data
+        if "x" in data:
+            # В Supabase доска хранится списком списков 3x3
+            db_data = {k: v for k, v in data.items() if k not in ("x", "o")}
+            db_data["board"] = masks_to_board(data["x"], data["o"])
+        query = supabase.table("games").update(db_data).eq("id", game_id)
+        for field, value in (expected or {}).items():
+            if value is None:
+                query = query.is_(field, "null")
+            elif isinstance(value, list):
+                # jsonb сравнивается с JSON-литералом, а не с repr() списка
+                query = query.eq(field, orjson.dumps(value).decode())
+            else:
+                query = query.eq(field, value)
+        result = await query.execute()
+        if expected and not result.data:
+            # Игру уже изменил другой запрос или воркер — закэшированная версия устарела
+            drop_cached_game(game_id)
+            return False
+        if result.data:
+            # UPDATE возвращает строку целиком — кэшируем актуальное состояние из БД
+            row = result.data[0]
+            try:
+                row["board"] = parse_board(row.get("board"))
+                cache_game(row)
+            except ValueError:
+                drop_cached_game(game_id)
+        else:
+            cached = GAME_CACHE.get(game_id)
+            if cached is not None:
+                cached.update(data)
+                mark_game_changed(game_id)
+        return True
     except Exception as e:
+        # Запись не прошла — сбрасываем кэш, чтобы следующее чтение взяло данные из БД
+        drop_cached_game(game_id)
         logger.error(f"Ошибка обновления игры: {e}")
+        return False
 
-def update_stats(user_id: str, username: str, field: str):
-    try:
+STAT_FIELDS = ("wins", "losses", "draws")
+# Статистика копится в памяти и записывается в Supabase пачкой раз в STATS_FLUSH_INTERVAL секунд
+STATS_FLUSH_INTERVAL = 5
+pending_stats: Dict[str, dict] = {}
+
+def update_stats(results: Dict[str, tuple]):
+    # results: user_id -> (username, поле статистики)
+    for user_id, (username, field) in results.items():
         if not user_id:
-            return
-        res = supabase.table("stats").select("*").eq("user_id", user_id).execute()
-        if res.data:
-            current = res.data[0][field]
-            supabase.table("stats").update({field: current + 1}).eq("user_id", user_id).execute()
-        else:
-            supabase.table("stats").insert({"user_id": user_id, "username": username, field: 1}).execute()
+            continue
+        delta = pending_stats.setdefault(str(user_id), {"user_id": user_id, **{f: 0 for f in STAT_FIELDS}})
+        delta["username"] = username
+        delta[field] += 1
+
+def restore_stats(batch: Dict[str, dict]):
+    # Возвращаем несохранённые изменения, чтобы записать их при следующей попытке
+    for key, delta in batch.items():
+        pending = pending_stats.setdefault(key, delta)
+        if pending is not delta:
+            for f in STAT_FIELDS:
+                pending[f] += delta[f]
+
+async def flush_stats():
+    if not pending_stats:
+        return
+    batch = dict(pending_stats)
+    pending_stats.clear()
+    try:
+        # Одна RPC на все накопленные изменения: прибавление выполняется в БД атомарно
+        await supabase.rpc("bump_stats", {"p_rows": list(batch.values())}).execute()
+    except asyncio.CancelledError:
+        # Отмена во время RPC (остановка сервера): пачку допишет финальный flush_stats
+        restore_stats(batch)
+        raise
     except Exception as e:
         logger.error(f"Ошибка обновления статистики: {e}")
-
-def check_win(board: list, symbol: str) -> bool:
-    # board уже должен быть списком списков к моменту вызова этой функции
-    try:
-        for i in range(3):
-            if all(board[i][j] == symbol for j in range(3)) or all(board[j][i] == symbol for j in range(3)):
-                return True
-        if all(board[i][i] == symbol for i in range(3)) or all(board[i][2 - i] == symbol for i in range(3)):
-            return True
-        return False
-    except (TypeError, IndexError) as e:
-        logger.error(f"Ошибка в check_win: {e}, board: {board}")
-        return False # Не считаем победу, если доска испорчена
+        restore_stats(batch)
+
+async def stats_flusher():
+    while True:
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
+        await flush_stats()
+
+# Сообщения чата сохраняются фоновой задачей пачками до CHAT_BATCH_SIZE строк
+CHAT_BATCH_SIZE = 50
+CHAT_SAVE_ATTEMPTS = 3
+chat_queue: asyncio.Queue = asyncio.Queue(maxsize=10_000)
+# Пачка, которую chat_writer не успел записать из-за отмены; её дописывает lifespan
+unsaved_chat: list = []
+
+async def save_chat_messages(batch: list):
+    for attempt in range(1, CHAT_SAVE_ATTEMPTS + 1):
+        try:
+            await supabase.table("messages").insert(batch).execute()
+            return
+        except Exception as e:
+            logger.error(f"Ошибка сохранения сообщений чата (попытка {attempt}): {e}")
+            if attempt < CHAT_SAVE_ATTEMPTS:
+                await asyncio.sleep(attempt)
+    logger.error(f"Сообщения чата не сохранены после {CHAT_SAVE_ATTEMPTS} попыток, потеряно: {len(batch)}")
+
+def drain_chat_queue(limit: Optional[int] = None) -> list:
+    batch = []
+    while not chat_queue.empty() and (limit is None or len(batch) < limit):
+        batch.append(chat_queue.get_nowait())
+    return batch
+
+async def chat_writer():
+    while True:
+        batch = [await chat_queue.get()]
+        batch += drain_chat_queue(CHAT_BATCH_SIZE - 1)
+        try:
+            await save_chat_messages(batch)
+        except asyncio.CancelledError:
+            # Отмена во время записи (остановка сервера): пачка уже снята с очереди, сохраняем её отдельно
+            unsaved_chat.extend(batch)
+            raise
+
+# Периодический запрос не даёт соединению и бесплатному инстансу Supabase простаивать
+SUPABASE_KEEPALIVE_INTERVAL = 240
+
+async def warm_supabase():
+    for table, column in (("games", "id"), ("stats", "user_id")):
+        try:
+            await supabase.table(table).select(column).limit(1).execute()
+        except Exception as e:
+            logger.warning(f"Не удалось прогреть соединение с Supabase ({table}): {e}")
+
+async def supabase_keepalive():
+    while True:
+        await asyncio.sleep(SUPABASE_KEEPALIVE_INTERVAL)
+        await warm_supabase()
 
 # Lifespan
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global session, supabase
-    session = aiohttp.ClientSession()
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    bot = Bot(token=BOT_TOKEN)
-    await bot.set_webhook(f"{WEBHOOK_URL}/webhook")
+    global supabase, redis_client
+    # hashlib использует SHA-256 из OpenSSL (с SHA-NI на поддерживающих процессорах)
+    logger.info(f"Проверка initData: HMAC-SHA256 через {ssl.OPENSSL_VERSION}")
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+    # Лёгкие запросы при старте: холодный старт Supabase, DNS и TLS не достаются первому пользователю
+    await warm_supabase()
+    # Один экземпляр Bot на процесс: его aiohttp-сессия переиспользуется всеми вебхуками
+    app.state.bot = Bot(token=BOT_TOKEN)
+    await app.state.bot.set_webhook(f"{WEBHOOK_URL}/webhook")
+    # WEBHOOK_URL не меняется, поэтому index.html подготавливаем один раз при старте
+    with open("static/index.html", "rb") as f:
+        app.state.index_html = f.read().replace(b"{{WEBHOOK_URL}}", WEBHOOK_URL.encode())
+    if REDIS_URL:
+        redis_client = aioredis.from_url(REDIS_URL)
+    flusher = asyncio.create_task(stats_flusher())
+    writer = asyncio.create_task(chat_writer())
+    keepalive = asyncio.create_task(supabase_keepalive())
     yield
-    await session.close()
-    await bot.session.close()
-
-app = FastAPI(lifespan=lifespan)
+    keepalive.cancel()
+    flusher.cancel()
+    # Дожидаемся отмены: прерванная пачка успевает вернуться в pending_stats до финальной записи
+    await asyncio.gather(flusher, return_exceptions=True)
+    await flush_stats()
+    writer.cancel()
+    await asyncio.gather(writer, return_exceptions=True)
+    rest = unsaved_chat + drain_chat_queue()
+    if rest:
+        await save_chat_messages(rest)
+    relays = list(redis_relays.values())
+    for relay in relays:
+        relay.cancel()
+    # Подписки закрываются в самих задачах, поэтому ждём их до закрытия клиента
+    await asyncio.gather(*relays, return_exceptions=True)
+    if redis_client is not None:
+        await redis_client.aclose()
+    await app.state.bot.session.close()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # CORS
 app.add_middleware(
@@ -173,80 +482,210 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+# Endpoint to serve the index.html file, replacing the placeholder
+# Регистрируется до монтирования /mini, иначе запрос перехватит StaticFiles
+@app.get("/mini/index.html")
+async def serve_index(request: Request):
+    return Response(
+        content=request.app.state.index_html,
+        media_type="text/html",
+        headers={"Cache-Control": "public, max-age=300"}
+    )
+
 app.mount("/mini", StaticFiles(directory="static"), name="mini")
 
 # WebSockets
 @app.websocket("/ws/{game_id}")
 async def game_websocket(websocket: WebSocket, game_id: str):
-    await websocket.accept()
-    if game_id not in active_connections:
-        active_connections[game_id] = []
-    active_connections[game_id].append(weakref.ref(websocket))
     try:
-        game = get_game_by_id(game_id)
+        user = validate_init_data(websocket.query_params.get("initData", ""))
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    if len(socket_writers) >= MAX_CONNECTIONS or user_connections[user["id"]] >= MAX_CONNECTIONS_PER_USER:
+        logger.warning(f"Превышен лимит WebSocket-соединений, пользователь {user['id']}")
+        await websocket.close(code=1013)
+        return
+    # Место занимаем до первого await: параллельные рукопожатия видят его и не обходят лимит.
+    # Писатель ждёт первый кадр в очереди, а кадры появляются только после accept
+    websocket.state.user_id = user["id"]
+    user_connections[user["id"]] += 1
+    queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+    socket_writers[websocket] = (queue, asyncio.create_task(socket_writer(game_id, websocket, queue)))
+    try:
+        await websocket.accept()
+    except BaseException:
+        disconnect(game_id, websocket)
+        raise
+    active_connections[game_id].add(websocket)
+    if redis_client is not None and game_id not in redis_relays:
+        redis_relays[game_id] = asyncio.create_task(relay_channel(game_id))
+    try:
+        game = await get_game_by_id(game_id)
         if game:
-            await websocket.send_json({"type": "game", **game[0]})
+            queue.put_nowait(pack_message(MSG_GAME, project_game(game)))
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
         logger.info(f"WebSocket отключен для игры {game_id}")
-        active_connections[game_id] = [ref for ref in active_connections[game_id] if ref() is not None]
-        if not active_connections[game_id]:
-            del active_connections[game_id]
     except Exception as e:
         logger.error(f"Ошибка WebSocket для игры {game_id}: {e}")
-        active_connections[game_id] = [ref for ref in active_connections[game_id] if ref() is not None]
-        if not active_connections[game_id]:
-            del active_connections[game_id]
+    finally:
+        # Выполняется при любом завершении обработчика, включая отмену задачи
+        disconnect(game_id, websocket)
+
+async def socket_writer(game_id: str, websocket: WebSocket, queue: asyncio.Queue):
+    try:
+        while True:
+            payload = await queue.get()
+            await websocket.send_bytes(payload)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # Сокет, на который не удалось отправить, больше не участвует в рассылках
+        logger.error(f"Ошибка отправки сообщения в WebSocket: {e}")
+        disconnect(game_id, websocket)
+
+async def close_slow_socket(websocket: WebSocket):
+    try:
+        await websocket.close(code=1013, reason="Клиент не успевает получать сообщения")
+    except Exception as e:
+        logger.error(f"Ошибка закрытия WebSocket: {e}")
+
+def disconnect(game_id: str, websocket: WebSocket):
+    writer = socket_writers.pop(websocket, None)
+    if writer is not None:
+        user_id = websocket.state.user_id
+        user_connections[user_id] -= 1
+        if not user_connections[user_id]:
+            del user_connections[user_id]
+        if writer[1] is not asyncio.current_task():
+            writer[1].cancel()
+    sockets = active_connections.get(game_id)
+    if sockets is None:
+        return
+    sockets.discard(websocket)
+    if not sockets:
+        release_game(game_id)
+
+def release_game(game_id: str):
+    # Локальных сокетов игры не осталось: освобождаем кэш и подписку Redis
+    active_connections.pop(game_id, None)
+    drop_cached_game(game_id)
+    last_broadcasts.pop(game_id, None)
+    relay = redis_relays.pop(game_id, None)
+    if relay is not None:
+        relay.cancel()
 
 @app.websocket("/ws/chat/{game_id}")
 async def chat_websocket(websocket: WebSocket, game_id: str):
+    # initData проверяется один раз при подключении, а не в каждом сообщении
+    try:
+        user = validate_init_data(websocket.query_params.get("initData", ""))
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
     await websocket.accept()
     try:
         while True:
             data = await websocket.receive_text()
-            msg = json.loads(data)
-            user = validate_init_data(msg["initData"], BOT_TOKEN)
-            supabase.table("messages").insert({
+            msg = orjson.loads(data)
+            # Обрезаем один раз: в БД и в рассылку уходит один и тот же текст
+            text = msg["text"][:100]
+            # В БД сообщение пишет chat_writer — рассылка не ждёт Supabase
+            await chat_queue.put({
                 "game_id": game_id,
                 "user_id": user["id"],
                 "username": user["first_name"],
-                "text": msg["text"][:100]
-            }).execute()
+                "text": text
+            })
             full_msg = {
-                "type": "chat",
                 "username": user["first_name"],
-                "text": msg["text"][:100],
+                "text": text,
                 "timestamp": time.time()
             }
-            if game_id in active_connections:
-                for ref in active_connections[game_id][:]:
-                    ws = ref()
-                    if ws:
-                        try:
-                            await ws.send_json(full_msg)
-                        except Exception as e:
-                            logger.error(f"Ошибка отправки сообщения в WebSocket: {e}")
+            await broadcast(game_id, pack_message(MSG_CHAT, full_msg))
     except WebSocketDisconnect:
         logger.info(f"WebSocket чата отключен для игры {game_id}")
     except Exception as e:
         logger.error(f"Ошибка WebSocket чата для игры {game_id}: {e}")
 
-async def broadcast_game_update(game_id: str):
+async def broadcast(game_id: str, payload: bytes):
+    if redis_client is not None:
+        # Каждый воркер получит payload из канала и разошлёт своим сокетам в relay_channel
+        try:
+            await redis_client.publish(f"game:{game_id}", payload)
+            return
+        except Exception as e:
+            logger.error(f"Ошибка публикации в Redis для игры {game_id}: {e}")
+    send_local(game_id, payload)
+
+async def relay_channel(game_id: str):
+    delay = REDIS_RETRY_DELAY
+    # Пока у игры есть сокеты на этом воркере, после ошибки подписываемся заново
+    while active_connections.get(game_id):
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(f"game:{game_id}")
+            delay = REDIS_RETRY_DELAY
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    if message["data"][:1] == MSG_GAME:
+                        # Игру изменил какой-то воркер: локальная копия могла устареть
+                        drop_cached_game(game_id)
+                    send_local(game_id, message["data"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка подписки Redis для игры {game_id}, повтор через {delay} с: {e}")
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception as e:
+                logger.error(f"Ошибка закрытия подписки Redis для игры {game_id}: {e}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, REDIS_RETRY_MAX_DELAY)
+    if redis_relays.get(game_id) is asyncio.current_task():
+        del redis_relays[game_id]
+
+def send_local(game_id: str, payload: bytes):
+    # payload кодируется один раз и кладётся в очередь каждого сокета игры без ожидания отправки
+    for ws in list(active_connections.get(game_id, ())):
+        writer = socket_writers.get(ws)
+        if writer is None:
+            continue
+        try:
+            writer[0].put_nowait(payload)
+        except asyncio.QueueFull:
+            # Клиент не успевает читать: отключаем его, а не копим кадры в памяти
+            logger.warning(f"Очередь отправки WebSocket переполнена, отключаем клиента игры {game_id}")
+            disconnect(game_id, ws)
+            task = asyncio.create_task(close_slow_socket(ws))
+            closing_sockets.add(task)
+            task.add_done_callback(closing_sockets.discard)
+
+def schedule_game_update(game_id: str, game: dict):
+    pending_games[game_id] = game
+    if game_id not in pending_updates:
+        pending_updates[game_id] = asyncio.create_task(flush_game_update(game_id))
+
+async def flush_game_update(game_id: str):
+    await asyncio.sleep(BROADCAST_COALESCE_DELAY)
+    # Снимаем отметку до рассылки: изменения во время неё запланируют новый кадр
+    pending_updates.pop(game_id, None)
+    await broadcast_game_update(game_id, pending_games.pop(game_id))
+
+async def broadcast_game_update(game_id: str, game: dict):
     try:
-        game_list = get_game_by_id(game_id)
-        if not game_list:
+        payload = pack_message(MSG_GAME, project_game(game))
+        now = time.monotonic()
+        last = last_broadcasts.get(game_id)
+        if last is not None and last[0] == payload and now - last[1] < BROADCAST_DEDUP_WINDOW:
             return
-        game = game_list[0]
-        msg = {"type": "game", **game}
         if game_id in active_connections:
-            for ref in active_connections[game_id][:]:
-                ws = ref()
-                if ws:
-                    try:
-                        await ws.send_json(msg)
-                    except Exception as e:
-                        logger.error(f"Ошибка отправки сообщения в WebSocket: {e}")
+            # Запись удаляется в release_game вместе с последним сокетом игры
+            last_broadcasts[game_id] = (payload, now)
+        await broadcast(game_id, payload)
     except Exception as e:
         logger.error(f"Ошибка трансляции обновления игры: {e}")
 
@@ -254,16 +693,12 @@ async def broadcast_game_update(game_id: str):
 @app.post("/api/create-game")
 async def create_game(request: Request):
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
         logger.info(f"Получены данные initData: {data.get('initData')}")
-        user = validate_init_data(data["initData"], BOT_TOKEN)
-        game_id = str(uuid.uuid4())[:8]
-        while not is_game_id_unique(game_id):
-            game_id = str(uuid.uuid4())[:8]
+        user = validate_init_data(data["initData"])
         # board должен быть списком списков
         initial_board = [[None]*3 for _ in range(3)]
-        supabase.table("games").insert({
-            "id": game_id,
+        new_game = {
             "creator_id": user["id"],
             "creator_name": user["first_name"],
             "current_turn": user["id"],
@@ -271,7 +706,9 @@ async def create_game(request: Request):
             "game_started": False,  # Игра не начинается автоматически
             "winner": None, # Добавляем поле winner при создании
             "created_at": time.strftime("%Y-%m-%d %H:%M:%S")
-        }).execute()
+        }
+        game_id = await insert_new_game(new_game)
+        cache_game(new_game)
         invite_link = f"http://t.me/Alex_tictactoeBot?start={game_id}"
         logger.info(f"Игра создана: {game_id}")
         return {"game_id": game_id, "invite_link": invite_link}
@@ -282,21 +719,22 @@ async def create_game(request: Request):
 @app.post("/api/join-game")
 async def join_game(request: Request):
     try:
-        data = await request.json()
-        user = validate_init_data(data["initData"], BOT_TOKEN)
+        data = orjson.loads(await request.body())
+        user = validate_init_data(data["initData"])
         game_id = data["game_id"]
-        game_list = get_game_by_id(game_id)
-        if not game_list:
-            raise HTTPException(status_code=404, detail="Игра не найдена")
-        game = game_list[0]
-        if game.get("opponent_id") or str(game["creator_id"]) == str(user["id"]):
-            raise HTTPException(status_code=400, detail="Невозможно присоединиться к игре")
-        update_game(game_id, {
+        def check(game):
+            if game.get("opponent_id") or str(game["creator_id"]) == str(user["id"]):
+                raise HTTPException(status_code=400, detail="Невозможно присоединиться к игре")
+        game = await get_checked_game(game_id, check)
+        changes = {
             "opponent_id": user["id"],
             "opponent_name": user["first_name"],
             "game_started": False  # Игра не начинается автоматически
-        })
-        await broadcast_game_update(game_id)
+        }
+        # Кэш мог устареть (другой воркер): присоединяемся, только если место в БД всё ещё свободно
+        if not await update_game(game_id, changes, expected={"opponent_id": None}):
+            raise HTTPException(status_code=409, detail="Состояние игры изменилось, повторите запрос")
+        schedule_game_update(game_id, {**game, **changes})
         return {"status": "ok"}
     except HTTPException:
         raise
@@ -307,22 +745,23 @@ async def join_game(request: Request):
 @app.post("/api/start-game")
 async def start_game(request: Request):
     try:
-        data = await request.json()
-        user = validate_init_data(data["initData"], BOT_TOKEN)
+        data = orjson.loads(await request.body())
+        user = validate_init_data(data["initData"])
         game_id = data["game_id"]
-        game_list = get_game_by_id(game_id)
-        if not game_list:
-            raise HTTPException(status_code=404, detail="Игра не найдена")
-        game = game_list[0]
-        if not game.get("opponent_id") or game.get("game_started"):
-            raise HTTPException(status_code=400, detail="Невозможно начать игру")
-        if str(user["id"]) != str(game["opponent_id"]): # Только второй игрок может начать
-            raise HTTPException(status_code=403, detail="Только второй игрок может начать игру")
-        update_game(game_id, {
+        def check(game):
+            if not game.get("opponent_id") or game.get("game_started"):
+                raise HTTPException(status_code=400, detail="Невозможно начать игру")
+            if str(user["id"]) != str(game["opponent_id"]): # Только второй игрок может начать
+                raise HTTPException(status_code=403, detail="Только второй игрок может начать игру")
+        game = await get_checked_game(game_id, check)
+        changes = {
             "game_started": True,
             "current_turn": game["creator_id"]  # Начинает первый игрок
-        })
-        await broadcast_game_update(game_id)
+        }
+        # Повторный start-game на другом воркере не должен сбросить ход посреди партии
+        if not await update_game(game_id, changes, expected={"game_started": False}):
+            raise HTTPException(status_code=409, detail="Состояние игры изменилось, повторите запрос")
+        schedule_game_update(game_id, {**game, **changes})
         return {"status": "ok"}
     except HTTPException:
         raise
@@ -333,58 +772,65 @@ async def start_game(request: Request):
 @app.post("/api/make-move")
 async def make_move(request: Request):
     try:
-        data = await request.json()
-        user = validate_init_data(data["initData"], BOT_TOKEN)
+        data = orjson.loads(await request.body())
+        user = validate_init_data(data["initData"])
         game_id = data["game_id"]
         row, col = data["row"], data["col"]
         if not (0 <= row <= 2 and 0 <= col <= 2):
             raise HTTPException(status_code=400, detail="Некорректные координаты")
-        game_list = get_game_by_id(game_id)
-        if not game_list:
-            raise HTTPException(status_code=404, detail="Игра не найдена")
-        game = game_list[0]
-        if not game.get("game_started"):
-            raise HTTPException(status_code=400, detail="Игра ещё не началась")
-        # Проверка на победителя/ничью: разрешаем ход, только если игра не закончена
-        if game.get("winner") is not None:
-             raise HTTPException(status_code=400, detail="Игра уже завершена")
-        if game["current_turn"] != user["id"]:
-            raise HTTPException(status_code=400, detail="Сейчас не ваша очередь ходить")
+        bit = 1 << (row * 3 + col)
+        def check(game):
+            if not game.get("game_started"):
+                raise HTTPException(status_code=400, detail="Игра ещё не началась")
+            # Проверка на победителя/ничью: разрешаем ход, только если игра не закончена
+            if game.get("winner") is not None:
+                raise HTTPException(status_code=400, detail="Игра уже завершена")
+            if game["current_turn"] != user["id"]:
+                raise HTTPException(status_code=400, detail="Сейчас не ваша очередь ходить")
+            if (game["x"] | game["o"]) & bit:
+                raise HTTPException(status_code=400, detail="Эта ячейка уже занята")
+        game = await get_checked_game(game_id, check)
         symbol = "X" if user["id"] == game["creator_id"] else "O"
-        board = game["board"] # board должен быть списком списков благодаря get_game_by_id
-        if board[row][col] is not None:
-            raise HTTPException(status_code=400, detail="Эта ячейка уже занята")
-        board[row][col] = symbol
+        x, o = game["x"], game["o"]
+        if symbol == "X":
+            x |= bit
+        else:
+            o |= bit
         winner = None
-        if check_win(board, symbol):
+        if check_win(x if symbol == "X" else o):
             winner = symbol
-        elif all(cell is not None for r in board for cell in r):
+        elif x | o == FULL_BOARD:
             winner = "draw"
         next_turn = None if winner else (
             game["opponent_id"] if user["id"] == game["creator_id"] else game["creator_id"]
         )
-        update_game(game_id, {
-            "board": board, # board как список списков
+        # Ход записывается, только если в БД всё ещё ход этого игрока, игра не завершена
+        # и доска та же, от которой считался ход: устаревший кэш не затрёт чужие ходы
+        changes = {
+            "x": x,
+            "o": o,
             "current_turn": next_turn,
             "winner": winner # Обновляем победителя
+        }
+        applied = await update_game(game_id, changes, expected={
+            "current_turn": user["id"],
+            "winner": None,
+            "board": masks_to_board(game["x"], game["o"])
         })
+        if not applied:
+            raise HTTPException(status_code=409, detail="Состояние игры изменилось, повторите ход")
         if winner:
             c_id = game["creator_id"]
             o_id = game.get("opponent_id")
             c_name = game["creator_name"]
             o_name = game.get("opponent_name", "Unknown")
             if winner == "X":
-                update_stats(c_id, c_name, "wins")
-                if o_id:
-                    update_stats(o_id, o_name, "losses")
-            elif winner == "O" and o_id:
-                update_stats(o_id, o_name, "wins")
-                update_stats(c_id, c_name, "losses")
+                update_stats({c_id: (c_name, "wins"), o_id: (o_name, "losses")})
+            elif winner == "O":
+                update_stats({o_id: (o_name, "wins"), c_id: (c_name, "losses")})
             elif winner == "draw":
-                update_stats(c_id, c_name, "draws")
-                if o_id:
-                    update_stats(o_id, o_name, "draws")
-        await broadcast_game_update(game_id)
+                update_stats({c_id: (c_name, "draws"), o_id: (o_name, "draws")})
+        schedule_game_update(game_id, {**game, **changes})
         return {"status": "ok"}
     except HTTPException:
         raise
@@ -395,13 +841,12 @@ async def make_move(request: Request):
 @app.post("/api/restart-game")
 async def restart_game(request: Request):
     try:
-        data = await request.json()
-        user = validate_init_data(data["initData"], BOT_TOKEN)
+        data = orjson.loads(await request.body())
+        user = validate_init_data(data["initData"])
         old_game_id = data["game_id"]
-        old_game_list = get_game_by_id(old_game_id)
-        if not old_game_list:
+        old_game = await get_game_by_id(old_game_id)
+        if not old_game:
             raise HTTPException(status_code=404, detail="Старая игра не найдена")
-        old_game = old_game_list[0]
 
         # Проверяем, что запрос от создателя старой игры
         if str(user["id"]) != str(old_game["creator_id"]):
@@ -412,12 +857,8 @@ async def restart_game(request: Request):
              raise HTTPException(status_code=400, detail="Невозможно перезапустить незавершённую игру")
 
         # Создаём новую игру с теми же ID игроков
-        new_game_id = str(uuid.uuid4())[:8]
-        while not is_game_id_unique(new_game_id):
-            new_game_id = str(uuid.uuid4())[:8]
         initial_board = [[None]*3 for _ in range(3)]
-        supabase.table("games").insert({
-            "id": new_game_id,
+        new_game = {
             "creator_id": old_game["creator_id"],
             "creator_name": old_game["creator_name"],
             "opponent_id": old_game.get("opponent_id"), # Переносим ID второго игрока
@@ -427,19 +868,18 @@ async def restart_game(request: Request):
             "game_started": True,  # Новая игра сразу начинается
             "winner": None,
             "created_at": time.strftime("%Y-%m-%d %H:%M:%S")
-        }).execute()
+        }
+        new_game_id = await insert_new_game(new_game)
+        cached = cache_game(new_game)
 
         # Закрываем WebSocket старой игры
         if old_game_id in active_connections:
-            for ref in active_connections[old_game_id][:]:
-                ws = ref()
-                if ws:
-                    await ws.close(code=1000, reason="Игра перезапущена") # Код 1000 - нормальное закрытие
-            del active_connections[old_game_id]
+            for ws in list(active_connections[old_game_id]):
+                await ws.close(code=1000, reason="Игра перезапущена") # Код 1000 - нормальное закрытие
+        release_game(old_game_id)
 
         # Рассылаем сообщение о новой игре
-        new_game_data = get_game_by_id(new_game_id)[0]
-        await broadcast_game_update(new_game_id)
+        schedule_game_update(new_game_id, cached)
 
         logger.info(f"Игра перезапущена: {old_game_id} -> {new_game_id}")
         return {"new_game_id": new_game_id, "status": "ok"}
@@ -456,17 +896,23 @@ async def get_stats(request: Request):
         init_data = request.headers.get("X-Init-Data")
         if not init_data:
             raise HTTPException(status_code=400, detail="Отсутствует X-Init-Data")
-        user = validate_init_data(init_data, BOT_TOKEN)
-        res = supabase.table("stats").select("*").eq("user_id", user["id"]).execute()
+        user = validate_init_data(init_data)
+        res = await supabase.table("stats").select("*").eq("user_id", user["id"]).execute()
         if res.data: # Исправлено: res.data, а не res.
-            return res.data[0]
-        return {
-            "user_id": user["id"],
-            "username": user["first_name"],
-            "wins": 0,
-            "losses": 0,
-            "draws": 0
-        }
+            stats = res.data[0]
+        else:
+            stats = {
+                "user_id": user["id"],
+                "username": user["first_name"],
+                "wins": 0,
+                "losses": 0,
+                "draws": 0
+            }
+        # Добавляем результаты, ещё не записанные в Supabase
+        delta = pending_stats.get(str(user["id"]))
+        if delta:
+            stats = {**stats, **{f: (stats.get(f) or 0) + delta[f] for f in STAT_FIELDS}}
+        return stats
     except HTTPException:
         raise
     except Exception as e:
@@ -476,24 +922,20 @@ async def get_stats(request: Request):
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
     try:
-        bot = Bot(token=BOT_TOKEN)
-        update_data = await request.json()
+        bot = request.app.state.bot
+        update_data = orjson.loads(await request.body())
         update = Update(**update_data)
         if update.message and update.message.text:
             text = update.message.text.strip()
             user_id = update.message.from_user.id
             if text == "/start":
-                kb = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="Создать новую игру", web_app=WebAppInfo(url=f"{WEBHOOK_URL}/mini/index.html"))]
-                ])
-                await bot.send_message(user_id, "Нажмите, чтобы создать новую игру!", reply_markup=kb)
+                await bot.send_message(user_id, "Нажмите, чтобы создать новую игру!", reply_markup=START_KB)
             elif text.startswith("/start "):
                 game_id = text.split(" ", 1)[1].strip()
-                game_list = get_game_by_id(game_id)
-                if not game_list:
+                game = await get_game_by_id(game_id)
+                if not game:
                     await bot.send_message(user_id, "❌ Игра не найдена.")
                     return {"ok": True}
-                game = game_list[0]
                 if game.get("opponent_id"):
                     await bot.send_message(user_id, "❌ Игра уже заполнена.")
                 elif str(game["creator_id"]) == str(user_id):
@@ -508,12 +950,3 @@ async def telegram_webhook(request: Request):
     except Exception as e:
         logger.error(f"Ошибка вебхука: {e}")
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
-
-# Endpoint to serve the index.html file, replacing the placeholder
-@app.get("/mini/index.html")
-async def serve_index():
-    with open("static/index.html", "r", encoding="utf-8") as f:
-        content = f.read()
-    # Replace the placeholder with the actual URL
-    content = content.replace("{{WEBHOOK_URL}}", WEBHOOK_URL)
-    return content
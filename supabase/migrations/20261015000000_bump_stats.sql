@@ -0,0 +1,15 @@
+-- Атомарно прибавляет результаты игр к статистике: одна строка на игрока,
+-- p_rows = [{"user_id": ..., "username": ..., "wins": ..., "losses": ..., "draws": ...}, ...]
+create or replace function bump_stats(p_rows jsonb)
+returns void
+language sql
+as $$
+    insert into stats (user_id, username, wins, losses, draws)
+    select r.user_id, r.username, r.wins, r.losses, r.draws
+    from jsonb_to_recordset(p_rows) as r(user_id bigint, username text, wins int, losses int, draws int)
+    on conflict (user_id) do update set
+        username = excluded.username,
+        wins = coalesce(stats.wins, 0) + excluded.wins,
+        losses = coalesce(stats.losses, 0) + excluded.losses,
+        draws = coalesce(stats.draws, 0) + excluded.draws;
+$$;
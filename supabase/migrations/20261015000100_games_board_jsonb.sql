@@ -0,0 +1,2 @@
+-- Доска хранится как jsonb: Supabase отдаёт её готовым массивом 3x3, без разбора строки на сервере
+alter table games alter column board type jsonb using board::jsonb;